@@ -1,10 +1,26 @@
 import pandas as pd
-from flask import Flask, jsonify, request, render_template
+from flask import Flask, jsonify, request, render_template, Response, stream_with_context, send_file, g
 from flask_cors import CORS
 import os
+import io
 import re
+import csv
 import json
+import bisect
+import glob
+import uuid
+import logging
+import tempfile
+import contextlib
+import contextvars
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from urllib.parse import urlencode
+import time
+import threading
 import unicodedata
+try: import fcntl
+except ImportError: fcntl = None  # Windows: solo un proceso, alcanza con _LOCK_EVENTOS
 
 app = Flask(__name__, template_folder='templates')
 CORS(app)
@@ -19,6 +35,11 @@ FILE_PRECIOS_LINROS = "data_precios_linros.xlsx"
 FILE_PRECIOS_INTERINSUMO = "data_precios_interinsumo.xlsx"
 FILE_REGLAS = "data_reglas.xlsx"      
 FILE_DB_MANUAL = "db_manual.json"     
+FILE_FORMULAS = "data_formulas.xlsx"  # Recetas (BOM): PRODUCTO, COMPONENTE, KG, MANO DE OBRA/EMPAQUE
+FILE_FLETES = "data_fletes.xlsx"      # Matriz de fletes: DESTINO, COD. FLETE, KG DESDE, KG HASTA, TARIFA
+FILE_LOG_LENTAS = "consultas_lentas.{pid}.log"  # Uno por proceso: rotar un archivo compartido no es seguro
+FILE_EVENTOS = "eventos_cache.jsonl"  # Historial de generaciones compartido entre procesos
+DIR_EXPORTACIONES = "exportaciones"   # Lista completa ya generada por generación de cache
 
 # =========================================================
 # 📘 TARIFAS POR DEFECTO Y FLETES
@@ -34,6 +55,24 @@ TARIFAS_FLETE = {
 }
 RECARGO_PELIGROSO = 0.03  
 
+# =========================================================
+# 📡 EVENTOS EN VIVO (SSE)
+# =========================================================
+EVENTOS_MAX_HISTORIAL = 50    # Generaciones que se guardan en disco
+EVENTOS_MAX_CAMBIOS = 500     # Si cambian más filas, se avisa "completo" y el cliente recarga
+SSE_HEARTBEAT_SEG = 15
+SSE_POLL_SEG = 1.0
+
+# =========================================================
+# 🔎 TRAZAS Y CONSULTAS LENTAS
+# =========================================================
+UMBRAL_LENTAS_MS = float(os.environ.get("UMBRAL_LENTAS_MS", 100))  # Configurable sin tocar código
+LOG_LENTAS_MAX_BYTES = 1_000_000
+LOG_LENTAS_BACKUPS = 3
+TRAZAS_RECIENTES_MAX = 200
+RUTAS_SIN_TRAZA = ('/api/eventos',)  # Conexiones largas: su duración no es latencia
+FILE_GRABACION = os.environ.get("GRABAR_TRAFICO", "")  # JSONL para reproducir_trafico.py; vacío = no se graba
+
 TEXTO_PROVEEDORES = """
 [ALITECNO]
 SAL DE CURA CONCENTRADA TECNAS X 25kg
@@ -584,7 +623,120 @@ for linea in TEXTO_PROVEEDORES.strip().split('\n'):
 def detectar_proveedor_exacto(nombre_odoo):
     return DICCIONARIO_PROVEEDORES.get(" ".join(str(nombre_odoo).upper().strip().split()), "")
 
+# =========================================================
+# 🔎 TRAZAS POR REQUEST
+# =========================================================
+# Cada request abre una traza; span() agrega hijos (persistencia, reconstrucción,
+# serialización...). Fuera de un request span() no hace nada.
+_TRAZA_ACTUAL = contextvars.ContextVar('traza', default=None)
+TRAZAS_RECIENTES = deque(maxlen=TRAZAS_RECIENTES_MAX)
+
+log_lentas = logging.getLogger("consultas_lentas")
+log_lentas.propagate = False
+log_lentas.setLevel(logging.INFO)
+_LOCK_LOG_LENTAS = threading.Lock()
+_PID_LOG_LENTAS = None
+
+def preparar_log_lentas():
+    # Se arma en el proceso que escribe (no al importar): con workers forkeados
+    # todos heredarían el archivo del proceso padre
+    global _PID_LOG_LENTAS
+    if _PID_LOG_LENTAS == os.getpid(): return
+    with _LOCK_LOG_LENTAS:
+        if _PID_LOG_LENTAS == os.getpid(): return
+        for h in list(log_lentas.handlers):
+            log_lentas.removeHandler(h)
+            h.close()
+        ruta = FILE_LOG_LENTAS.format(pid=os.getpid())
+        log_lentas.addHandler(RotatingFileHandler(ruta, maxBytes=LOG_LENTAS_MAX_BYTES, backupCount=LOG_LENTAS_BACKUPS, encoding='utf-8'))
+        _PID_LOG_LENTAS = os.getpid()
+        podar_logs_lentas()
+
+def proceso_vivo(pid):
+    if pid == os.getpid(): return True
+    if os.name != 'posix': return False  # Fuera de POSIX se corre un solo proceso (ver fcntl)
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: pass
+    return True
+
+def podar_logs_lentas():
+    # Sin esto cada reinicio o reciclaje de worker deja hasta LOG_LENTAS_BACKUPS + 1 archivos
+    patron = FILE_LOG_LENTAS.format(pid='*')
+    for ruta in glob.glob(patron) + glob.glob(f"{patron}.*"):
+        m = re.search(r'\.(\d+)\.log', os.path.basename(ruta))
+        if m and not proceso_vivo(int(m.group(1))): borrar_archivo(ruta)
+
+@contextlib.contextmanager
+def span(nombre, **atributos):
+    traza = _TRAZA_ACTUAL.get()
+    if traza is None:
+        yield None
+        return
+    t = time.perf_counter()
+    s = {"nombre": nombre, "padre": traza['pila'][-1] if traza['pila'] else None,
+         "inicio_ms": round((t - traza['t0']) * 1000, 2), "ms": None, **atributos}
+    traza['spans'].append(s)
+    traza['pila'].append(len(traza['spans']) - 1)
+    try: yield s
+    finally:
+        s['ms'] = round((time.perf_counter() - t) * 1000, 2)
+        traza['pila'].pop()
+
+def iniciar_traza(ruta):
+    traza = {"id": uuid.uuid4().hex[:16], "ruta": ruta, "t0": time.perf_counter(), "spans": [], "pila": []}
+    return traza, _TRAZA_ACTUAL.set(traza)
+
+def registrar_consulta(ruta, consulta, resultados, ms):
+    if ms < UMBRAL_LENTAS_MS: return
+    preparar_log_lentas()
+    log_lentas.info(json.dumps({
+        "fecha": time.strftime('%Y-%m-%d %H:%M:%S'), "ruta": ruta, "consulta": consulta,
+        "resultados": resultados, "ms": round(ms, 2)
+    }, ensure_ascii=False))
+
+def leer_consultas_lentas():
+    entradas = []
+    patron = FILE_LOG_LENTAS.format(pid='*')
+    for ruta in glob.glob(patron) + glob.glob(f"{patron}.*"):
+        try:
+            with open(ruta, 'r', encoding='utf-8') as f: lineas = f.readlines()
+        except OSError: continue  # Rotado entre el glob y el open
+        for linea in lineas:
+            try: entradas.append(json.loads(linea))
+            except ValueError: pass
+    return entradas
+
+# =========================================================
+# 🎙️ GRABACIÓN DE TRÁFICO
+# =========================================================
+# Una línea por request con su instante de llegada (no el de la respuesta: una edición
+# de 350 ms se reproduciría 350 ms tarde), para reproducirla con reproducir_trafico.py.
+# Solo se guarda el cuerpo de los POST JSON (ediciones de admin); las subidas de Excel no.
+_LOCK_GRABACION = threading.Lock()
+
+def redactar(datos):
+    return {k: ("***" if k == 'token' else v) for k, v in datos.items()}
+
+def grabar_trafico(metodo, ruta, query, cuerpo, status, ms, llegada=None):
+    if not FILE_GRABACION: return
+    linea = json.dumps({
+        "t": round(llegada if llegada is not None else time.time() - ms / 1000, 3), "metodo": metodo, "ruta": ruta, "query": query,
+        "cuerpo": redactar(cuerpo) if isinstance(cuerpo, dict) else None, "status": status, "ms": round(ms, 2)
+    }, ensure_ascii=False)
+    with _LOCK_GRABACION:
+        with open(FILE_GRABACION, 'a', encoding='utf-8') as f: f.write(linea + "\n")
+
 CACHE_PRODUCTOS = []
+GENERACION_CACHE = 0
+_LOCK_CACHE = threading.Lock()
+_LOCK_EVENTOS = threading.Lock()
+_COND_EVENTOS = threading.Condition()
+_EVENTOS_RECIENTES = []
+_VIGIA_EVENTOS = None
+
+def clave_producto(p):
+    return f"{p['codigo']}_{p['nombre']}_{p['presentacion']}"
 
 def cargar_db_manual():
     if os.path.exists(FILE_DB_MANUAL):
@@ -597,7 +749,11 @@ def guardar_db_manual(nombre, campo, valor):
     datos = cargar_db_manual()
     if nombre not in datos: datos[nombre] = {}
     datos[nombre][campo] = valor
-    with open(FILE_DB_MANUAL, 'w', encoding='utf-8') as f: json.dump(datos, f, ensure_ascii=False, indent=4)
+    escribir_db_manual(datos)
+
+def escribir_db_manual(datos):
+    with span("db_manual.escribir"):
+        with open(FILE_DB_MANUAL, 'w', encoding='utf-8') as f: json.dump(datos, f, ensure_ascii=False, indent=4)
 
 def detectar_info_basica(nombre, codigo=""):
     nombre = str(nombre).upper()
@@ -621,58 +777,101 @@ def normalizar_texto(texto):
     t = str(texto).strip().upper()
     return ''.join(c for c in unicodedata.normalize('NFD', t) if unicodedata.category(c) != 'Mn')
 
+# =========================================================
+# 📐 COMPILADOR DE REGLAS MAESTRAS (VECTORIZADO)
+# =========================================================
+RE_PRESENTACION = r'\s*X?\s*\d+\.?\d*\s*(KG|G|L|LT|GALON|ML)\s*$'
+FLETE_DEFECTO = "FLETE LIM-AQP/TRUJ X KG"
+VALORES_SI = ['SI', 'YES', 'TRUE', '1']
+COLUMNAS_REGLA = ['fila', 'producto', 'nombre_base', 'margen', 'envase', 'cod_flete', 'peligroso', 'costo_adicional']
+REPORTE_REGLAS = {}
+
+def calcular_nombre_base(nombre):
+    return re.sub(RE_PRESENTACION, '', str(nombre).upper()).strip()
+
+def texto_columna(serie):
+    # object y no el str de pandas 3 (Arrow/RE2): ahí \s no ve el espacio duro (\xa0)
+    # y los nombres dejarían de coincidir con calcular_nombre_base() y el loader anterior
+    return serie.astype(str).astype(object).str.upper().str.strip()
+
+def compilar_reglas(df):
+    df = df.copy()
+    df.columns = [normalizar_texto(c) for c in df.columns]
+    reporte = {"filas": len(df), "reglas": 0, "rechazadas": [], "advertencias": []}
+
+    col_prod = "PRODUCTO" if "PRODUCTO" in df.columns else None
+    col_margen = "MARGEN" if "MARGEN" in df.columns else None
+    col_envase = next((c for c in df.columns if 'ENVASE' in c), None) 
+    col_flete = next((c for c in df.columns if c in ["COD. FLETE", "COD FLETE", "FLETE"]), None) 
+    col_peligroso = "PELIGROSO" if "PELIGROSO" in df.columns else None
+    col_manual = next((c for c in df.columns if 'FABRICACION' in c or 'ADICIONAL' in c or 'MANUAL' in c), None)
+
+    if not col_prod:
+        reporte["rechazadas"].append({"fila": 1, "producto": "", "motivo": "Falta la columna PRODUCTO"})
+        return pd.DataFrame(columns=COLUMNAS_REGLA), reporte
+
+    vacia = pd.Series(float('nan'), index=df.index, dtype=object)
+    columna = lambda c: df[c] if c else vacia
+
+    # Fila tal como se ve en Excel (la 1 es el encabezado)
+    fila = pd.Series(range(2, len(df) + 2), index=df.index)
+    producto = texto_columna(df[col_prod])
+    valida = df[col_prod].notna() & (producto != "")
+    for f in fila[~valida].tolist():
+        reporte["rechazadas"].append({"fila": f, "producto": "", "motivo": "Producto vacío"})
+
+    m_raw = columna(col_margen)
+    margen_num = pd.to_numeric(m_raw, errors='coerce')
+    margen = margen_num.where(~(margen_num > 1), margen_num / 100).fillna(MARGEN_DEFECTO)
+
+    e_raw = columna(col_envase)
+    e_txt = e_raw.astype(str).astype(object).str.replace('$', '', regex=False).str.replace(',', '', regex=False).str.strip()
+    envase = pd.to_numeric(e_txt.where(e_raw.notna()), errors='coerce')
+
+    f_raw = columna(col_flete)
+    cod_flete = texto_columna(f_raw).where(f_raw.notna(), FLETE_DEFECTO)
+
+    p_raw = columna(col_peligroso)
+    peligroso = p_raw.notna() & texto_columna(p_raw).isin(VALORES_SI)
+
+    c_raw = columna(col_manual)
+    costo_adicional = pd.to_numeric(c_raw, errors='coerce')
+
+    for nombre_col, raw, valor in [("Margen", m_raw, margen_num), ("Envase", e_raw, envase), ("Costo adicional", c_raw, costo_adicional)]:
+        malas = valida & raw.notna() & valor.isna()
+        for f, prod, v in zip(fila[malas].tolist(), producto[malas].tolist(), raw[malas].tolist()):
+            reporte["advertencias"].append({"fila": f, "producto": prod, "motivo": f"{nombre_col} no numérico ({v!r}), se usa el valor por defecto"})
+
+    duplicada = valida & producto.where(valida).duplicated(keep='last')
+    for f, prod in zip(fila[duplicada].tolist(), producto[duplicada].tolist()):
+        reporte["advertencias"].append({"fila": f, "producto": prod, "motivo": "Producto repetido, se usa la última fila"})
+
+    tabla = pd.DataFrame({
+        'fila': fila, 'producto': producto,
+        'nombre_base': producto.str.replace(RE_PRESENTACION, '', regex=True).str.strip(),
+        'margen': margen, 'envase': envase.fillna(0.0), 'cod_flete': cod_flete,
+        'peligroso': peligroso, 'costo_adicional': costo_adicional.fillna(0.0),
+    })[valida].reset_index(drop=True)
+    reporte["reglas"] = len(tabla)
+    return tabla, reporte
+
+def reglas_desde_tabla(tabla):
+    reglas = {}
+    columnas = [tabla[c].tolist() for c in COLUMNAS_REGLA[1:]]
+    for nombre, nombre_base, m, e, f, p, cm in zip(*columnas):
+        dict_regla = {"margen": m, "envase": e, "cod_flete": f, "peligroso": p, "costo_adicional": cm}
+        reglas[nombre] = dict_regla
+        if nombre_base not in reglas: reglas[nombre_base] = dict_regla
+    return reglas
+
 def cargar_reglas_excel():
+    global REPORTE_REGLAS
     if not os.path.exists(FILE_REGLAS): return {}
     try:
         if FILE_REGLAS.endswith('.csv'): df = pd.read_csv(FILE_REGLAS)
         else: df = pd.read_excel(FILE_REGLAS)
-        df.columns = [normalizar_texto(c) for c in df.columns]
-        
-        col_prod = "PRODUCTO" if "PRODUCTO" in df.columns else None
-        col_margen = "MARGEN" if "MARGEN" in df.columns else None
-        col_envase = next((c for c in df.columns if 'ENVASE' in c), None) 
-        col_flete = next((c for c in df.columns if c in ["COD. FLETE", "COD FLETE", "FLETE"]), None) 
-        col_peligroso = "PELIGROSO" if "PELIGROSO" in df.columns else None
-        col_manual = next((c for c in df.columns if 'FABRICACION' in c or 'ADICIONAL' in c or 'MANUAL' in c), None)
-        
-        reglas = {}
-        if not col_prod: return {}
-
-        for _, row in df.iterrows():
-            if pd.isna(row[col_prod]): continue
-            nombre = str(row[col_prod]).upper().strip()
-            
-            m = MARGEN_DEFECTO
-            if col_margen and not pd.isna(row[col_margen]):
-                val = pd.to_numeric(row[col_margen], errors='coerce')
-                if not pd.isna(val): m = val / 100 if val > 1 else val
-            
-            e = 0.0
-            if col_envase and not pd.isna(row[col_envase]): 
-                val_str = str(row[col_envase]).replace('$', '').replace(',', '').strip()
-                val_e = pd.to_numeric(val_str, errors='coerce')
-                if not pd.isna(val_e): e = val_e
-                
-            f = "FLETE LIM-AQP/TRUJ X KG"
-            if col_flete and not pd.isna(row[col_flete]): f = str(row[col_flete]).upper().strip()
-            
-            p = False
-            if col_peligroso and not pd.isna(row[col_peligroso]):
-                val_p = str(row[col_peligroso]).upper().strip()
-                if val_p in ['SI', 'YES', 'TRUE', '1']: p = True
-            
-            cm = 0.0
-            if col_manual and not pd.isna(row[col_manual]):
-                val_m = pd.to_numeric(row[col_manual], errors='coerce')
-                if not pd.isna(val_m): cm = val_m
-
-            dict_regla = {"margen": m, "envase": e, "cod_flete": f, "peligroso": p, "costo_adicional": cm}
-            reglas[nombre] = dict_regla
-            
-            nombre_base = re.sub(r'\s*X?\s*\d+\.?\d*\s*(KG|G|L|LT|GALON|ML)\s*$', '', nombre).strip()
-            if nombre_base not in reglas: reglas[nombre_base] = dict_regla
-            
-        return reglas
+        tabla, REPORTE_REGLAS = compilar_reglas(df)
+        return reglas_desde_tabla(tabla)
     except Exception as e: return {}
 
 def cargar_y_limpiar_excel(filepath):
@@ -695,13 +894,198 @@ def cargar_y_limpiar_excel(filepath):
         return df
     except Exception as e: return None
 
+# =========================================================
+# 🧬 ÍNDICE DE FAMILIAS DE PRODUCTO
+# =========================================================
+# Familia = todas las presentaciones de Odoo con el mismo nombre_base, ordenadas
+# por kg, para buscar la variante más cercana con bisect. Depende solo de los
+# archivos de Odoo: si no cambiaron (editar margen/coyuntural, subir reglas o
+# recetas) procesar_excel() ni siquiera reagrupa. Si cambiaron, solo se reordenan
+# las familias cuyas variantes son distintas.
+
+def firma_archivo(ruta):
+    try:
+        st = os.stat(ruta)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError: return None
+
+class IndiceFamilias:
+    def __init__(self):
+        self.familias = {}  # nombre_base -> {'kgs', 'entradas', 'fuente', 'costo_base'}
+        self.firma = None   # firma de los archivos de Odoo con que se armó
+
+    def __contains__(self, nombre_base):
+        return nombre_base in self.familias
+
+    def _armar(self, variantes):
+        # El orden de llegada desempata igual que min() sobre la lista original
+        entradas = sorted(((v['kg'], i, v) for i, v in enumerate(variantes)), key=lambda e: (e[0], e[1]))
+        return {'kgs': [e[0] for e in entradas], 'entradas': entradas, 'fuente': list(variantes), 'costo_base': 0.0}
+
+    def sincronizar(self, variantes_por_base, costos_base):
+        cambiadas = set(b for b in self.familias if b not in variantes_por_base)
+        for b in cambiadas: del self.familias[b]
+
+        for nombre_base, variantes in variantes_por_base.items():
+            familia = self.familias.get(nombre_base)
+            if familia is None or familia['fuente'] != variantes:
+                familia = self.familias[nombre_base] = self._armar(variantes)
+                cambiadas.add(nombre_base)
+            familia['costo_base'] = costos_base.get(nombre_base, 0.0)
+        return cambiadas
+
+    def cercana(self, nombre_base, kg):
+        familia = self.familias.get(nombre_base)
+        if not familia or not familia['kgs']: return None
+        kgs, entradas = familia['kgs'], familia['entradas']
+        i = bisect.bisect_left(kgs, kg)
+        candidatos = []
+        if i < len(kgs): candidatos.append(entradas[i])
+        if i > 0: candidatos.append(entradas[bisect.bisect_left(kgs, kgs[i - 1])])
+        return min(candidatos, key=lambda e: (abs(e[0] - kg), e[1]))[2]
+
+    def costo_base(self, nombre_base):
+        familia = self.familias.get(nombre_base)
+        return familia['costo_base'] if familia else 0.0
+
+INDICE_FAMILIAS = IndiceFamilias()
+
+# =========================================================
+# 🧪 RECETAS (BOM) DE PRODUCTOS FABRICADOS
+# =========================================================
+# costo/kg = Σ(kg_componente × costo_componente) / Σ kg_componente + mano de obra/empaque
+# El costo de un componente es su coyuntural si existe, si no el actual (Odoo + Fab)
+# o el de su propia receta. Se evalúa en orden topológico y entre reconstrucciones
+# solo se recalcula lo que está aguas abajo de un costo que cambió.
+
+class RecetarioBOM:
+    def __init__(self):
+        self.recetas = {}        # producto -> {'componentes': {componente: kg}, 'extra': costo}
+        self.dependientes = {}   # componente -> {productos que lo usan}
+        self.orden = []
+        self.en_ciclo = []
+        self.calculados = {}     # producto -> costo BOM
+        self.faltantes = {}      # producto -> componentes sin costo
+        self.entradas = {}       # nodo -> costo de entrada usado en la última evaluación
+
+    def __contains__(self, producto):
+        return producto in self.recetas
+
+    def cargar(self, recetas):
+        self.recetas = recetas
+        self.dependientes = {}
+        for producto, receta in recetas.items():
+            for componente in receta['componentes']: self.dependientes.setdefault(componente, set()).add(producto)
+        self.orden, self.en_ciclo = self._ordenar()
+        self.calculados, self.faltantes, self.entradas = {}, {}, {}
+
+    def _ordenar(self):
+        # Kahn: lo que queda sin ordenar está en un ciclo o depende de uno
+        pendientes = {p: sum(1 for c in r['componentes'] if c in self.recetas) for p, r in self.recetas.items()}
+        listos = sorted((p for p, n in pendientes.items() if n == 0), reverse=True)
+        orden = []
+        while listos:
+            producto = listos.pop()
+            orden.append(producto)
+            for d in sorted(self.dependientes.get(producto, ()), reverse=True):
+                pendientes[d] -= 1
+                if pendientes[d] == 0: listos.append(d)
+        ordenados = set(orden)
+        return orden, sorted(p for p in self.recetas if p not in ordenados)
+
+    def aguas_abajo(self, nodos):
+        vistos, pila = set(), list(nodos)
+        while pila:
+            for d in self.dependientes.get(pila.pop(), ()):
+                if d not in vistos:
+                    vistos.add(d)
+                    pila.append(d)
+        return vistos
+
+    def _costo_componente(self, componente, costos, coyunturales):
+        if componente not in self.recetas: return costos.get(componente)
+        if coyunturales.get(componente, 0) > 0: return coyunturales[componente]
+        return self.calculados.get(componente)
+
+    def evaluar(self, costos, coyunturales):
+        cambiados = []
+        for nodo in set(self.dependientes) | set(self.recetas):
+            valor = coyunturales.get(nodo, 0) if nodo in self.recetas else costos.get(nodo)
+            if nodo not in self.entradas or self.entradas[nodo] != valor:
+                self.entradas[nodo] = valor
+                cambiados.append(nodo)
+
+        sucios = self.aguas_abajo(cambiados) | set(p for p in self.orden if p not in self.calculados and p not in self.faltantes)
+        recalculados = [p for p in self.orden if p in sucios]
+        for producto in recalculados:
+            receta = self.recetas[producto]
+            costos_comp = {c: self._costo_componente(c, costos, coyunturales) for c in receta['componentes']}
+            faltan = sorted(c for c, v in costos_comp.items() if v is None)
+            total_kg = sum(receta['componentes'].values())
+            if faltan or total_kg <= 0:
+                self.calculados.pop(producto, None)
+                self.faltantes[producto] = faltan
+                continue
+            self.faltantes.pop(producto, None)
+            self.calculados[producto] = sum(kg * costos_comp[c] for c, kg in receta['componentes'].items()) / total_kg + receta['extra']
+        return recalculados
+
+RECETARIO = RecetarioBOM()
+REPORTE_BOM = {}
+_FIRMA_FORMULAS = None
+
+def cargar_formulas_excel():
+    if not os.path.exists(FILE_FORMULAS): return {}
+    try:
+        if FILE_FORMULAS.endswith('.csv'): df = pd.read_csv(FILE_FORMULAS)
+        else: df = pd.read_excel(FILE_FORMULAS)
+        df.columns = [normalizar_texto(c) for c in df.columns]
+
+        col_prod = "PRODUCTO" if "PRODUCTO" in df.columns else None
+        col_comp = next((c for c in df.columns if 'COMPONENTE' in c or 'INSUMO' in c), None)
+        col_kg = next((c for c in df.columns if c not in (col_prod, col_comp) and ('KG' in c or 'CANTIDAD' in c)), None)
+        col_extra = next((c for c in df.columns if 'MANO' in c or 'EMPAQUE' in c or 'ADICIONAL' in c), None)
+        if not (col_prod and col_comp and col_kg): return {}
+
+        df = df[df[col_prod].notna() & df[col_comp].notna()]
+        kg = pd.to_numeric(df[col_kg], errors='coerce').fillna(0.0)
+        extra = pd.to_numeric(df[col_extra], errors='coerce') if col_extra else pd.Series(float('nan'), index=df.index)
+
+        recetas = {}
+        for producto, componente, k, e in zip(texto_columna(df[col_prod]).tolist(), texto_columna(df[col_comp]).tolist(), kg.tolist(), extra.tolist()):
+            receta = recetas.setdefault(producto, {'componentes': {}, 'extra': 0.0})
+            receta['componentes'][componente] = receta['componentes'].get(componente, 0.0) + k
+            if not pd.isna(e): receta['extra'] = e
+        return recetas
+    except Exception as e: return {}
+
+def actualizar_recetario():
+    global _FIRMA_FORMULAS
+    firma = firma_archivo(FILE_FORMULAS)
+    if firma != _FIRMA_FORMULAS:
+        RECETARIO.cargar(cargar_formulas_excel())
+        _FIRMA_FORMULAS = firma
+
+def evaluar_recetas(costos, coyunturales):
+    global REPORTE_BOM
+    recalculados = RECETARIO.evaluar(costos, coyunturales)
+    REPORTE_BOM = {
+        "recetas": len(RECETARIO.recetas), "recalculados": recalculados,
+        "ciclos": RECETARIO.en_ciclo, "faltantes": RECETARIO.faltantes,
+    }
+    return dict(RECETARIO.calculados)
+
 def procesar_excel():
     try:
         db_manual = cargar_db_manual()
-        reglas_excel = cargar_reglas_excel()
+        with span("excel.reglas"): reglas_excel = cargar_reglas_excel()
+        with span("excel.recetas"): actualizar_recetario()
         
-        df_linros = cargar_y_limpiar_excel(FILE_PRECIOS_LINROS)
-        df_inter = cargar_y_limpiar_excel(FILE_PRECIOS_INTERINSUMO)
+        with span("excel.odoo"):
+            # Se toma antes de leer: si el archivo cambia durante la lectura, la próxima vuelta reagrupa
+            firma_odoo = (firma_archivo(FILE_PRECIOS_LINROS), firma_archivo(FILE_PRECIOS_INTERINSUMO))
+            df_linros = cargar_y_limpiar_excel(FILE_PRECIOS_LINROS)
+            df_inter = cargar_y_limpiar_excel(FILE_PRECIOS_INTERINSUMO)
         
         dfs_to_concat = []
         if df_linros is not None: dfs_to_concat.append(df_linros)
@@ -717,8 +1101,10 @@ def procesar_excel():
         col_codigo = next((c for c in df.columns if 'codigo' in c or 'código' in c), None)
         col_unidad = next((c for c in df.columns if 'unidad' in c), None)
         
-        info_base = {} 
+        variantes_por_base = {}
+        costos_base = {}
         temp_data = []
+        agrupar = firma_odoo != INDICE_FAMILIAS.firma
 
         # 1. LEER ODOO
         if col_costo and col_nombre:
@@ -734,13 +1120,13 @@ def procesar_excel():
                 kg = detectar_info_basica(nombre_full, codigo)
                 proveedor = detectar_proveedor_exacto(nombre_full)
                 nombre_upper = nombre_full.upper()
-                nombre_base = re.sub(r'\s*X?\s*\d+\.?\d*\s*(KG|G|L|LT|GALON|ML)\s*$', '', nombre_upper).strip()
+                nombre_base = calcular_nombre_base(nombre_upper)
 
                 costo_base_usd = pd.to_numeric(row[col_costo], errors='coerce') or 0.0
                 
-                if nombre_base not in info_base: info_base[nombre_base] = {'variantes': [], 'costo_base': 0.0}
-                info_base[nombre_base]['variantes'].append({'kg': kg, 'codigo': codigo, 'categoria': categoria, 'marca': marca, 'unidad': unidad})
-                if costo_base_usd > 0.0001: info_base[nombre_base]['costo_base'] = costo_base_usd
+                if agrupar:
+                    variantes_por_base.setdefault(nombre_base, []).append({'kg': kg, 'codigo': codigo, 'categoria': categoria, 'marca': marca, 'unidad': unidad})
+                    if costo_base_usd > 0.0001: costos_base[nombre_base] = costo_base_usd
 
                 regla_maestra = reglas_excel.get(nombre_upper, reglas_excel.get(nombre_base))
                 costo_adicional = regla_maestra['costo_adicional'] if regla_maestra else 0.0
@@ -752,22 +1138,24 @@ def procesar_excel():
                     'costo_odoo_puro': costo_base_usd # Guardamos el costo puro para referencia
                 })
 
+        if agrupar:
+            INDICE_FAMILIAS.sincronizar(variantes_por_base, costos_base)
+            INDICE_FAMILIAS.firma = firma_odoo
         nombres_odoo = set(item['nombre'].upper() for item in temp_data)
 
         # 2. INYECTAR NUEVOS PRODUCTOS O VARIANTES DEL EXCEL MAESTRO
         for nombre_regla, regla in reglas_excel.items():
             if nombre_regla not in nombres_odoo:
                 kg = detectar_info_basica(nombre_regla)
-                nombre_base = re.sub(r'\s*X?\s*\d+\.?\d*\s*(KG|G|L|LT|GALON|ML)\s*$', '', nombre_regla).strip()
-                if nombre_regla == nombre_base and nombre_base in info_base: continue
+                nombre_base = calcular_nombre_base(nombre_regla)
+                if nombre_regla == nombre_base and nombre_base in INDICE_FAMILIAS: continue
                 
                 codigo, categoria, marca, unidad, costo_base_usd = "S/C", "OTROS", "GENERICO", "KG", 0.0
                 
-                if nombre_base in info_base and info_base[nombre_base]['variantes']:
-                    variantes = info_base[nombre_base]['variantes']
-                    var_cercana = min(variantes, key=lambda x: abs(x['kg'] - kg))
+                var_cercana = INDICE_FAMILIAS.cercana(nombre_base, kg)
+                if var_cercana:
                     codigo, categoria, marca, unidad = var_cercana['codigo'], var_cercana['categoria'], var_cercana['marca'], var_cercana['unidad']
-                    costo_base_usd = info_base[nombre_base]['costo_base']
+                    costo_base_usd = INDICE_FAMILIAS.costo_base(nombre_base)
 
                 costo_final = costo_base_usd + regla['costo_adicional']
                 proveedor = detectar_proveedor_exacto(nombre_regla)
@@ -778,35 +1166,51 @@ def procesar_excel():
                     'costo_odoo_puro': costo_base_usd
                 })
 
-        # 3. CÁLCULO FINAL MATEMÁTICO
-        resultados = []
+        # 3. COSTOS (ODOO + FAB, HERENCIA DE FAMILIA Y COYUNTURAL)
+        costeados = []
         for item in temp_data:
             nombre = item['nombre']
             nombre_u = nombre.upper()
             kg = item['kg']
             costo_actual = item['costo_usd'] # Este es el costo base de Odoo + Fab
-            nombre_base = re.sub(r'\s*X?\s*\d+\.?\d*\s*(KG|G|L|LT|GALON|ML)\s*$', '', nombre_u).strip()
+            nombre_base = calcular_nombre_base(nombre_u)
 
             if costo_actual <= 0.0001:
-                if nombre_base in info_base and info_base[nombre_base]['costo_base'] > 0: 
+                if INDICE_FAMILIAS.costo_base(nombre_base) > 0: 
                     r_aux = reglas_excel.get(nombre_u, reglas_excel.get(nombre_base))
                     add_cost = r_aux.get('costo_adicional', 0.0) if r_aux else 0.0
-                    costo_actual = info_base[nombre_base]['costo_base'] + add_cost
+                    costo_actual = INDICE_FAMILIAS.costo_base(nombre_base) + add_cost
                 elif nombre_u in reglas_excel or nombre_base in reglas_excel:
                     pass
                 elif nombre in db_manual and 'costo_coyuntural' in db_manual[nombre]:
                     pass
+                elif nombre_u in RECETARIO:
+                    pass
                 else:
                     continue
 
             # --- LÓGICA DE COSTO COYUNTURAL ---
             costo_coyuntural = 0.0
-            costo_para_calculo = costo_actual
-
             if nombre in db_manual and 'costo_coyuntural' in db_manual[nombre]:
                 if db_manual[nombre]['costo_coyuntural'] > 0:
                     costo_coyuntural = db_manual[nombre]['costo_coyuntural']
-                    costo_para_calculo = costo_coyuntural # Reemplaza al actual para el calculo final
+
+            costeados.append((item, nombre_base, costo_actual, costo_coyuntural))
+
+        # 4. RECETAS (BOM): el costo de lo que fabricamos sale de sus componentes
+        costos_bom = evaluar_recetas(
+            {item['nombre'].upper(): coy if coy > 0 else actual for item, _, actual, coy in costeados},
+            {item['nombre'].upper(): coy for item, _, _, coy in costeados if coy > 0}
+        )
+
+        # 5. CÁLCULO FINAL MATEMÁTICO
+        resultados = []
+        for item, nombre_base, costo_actual, costo_coyuntural in costeados:
+            nombre = item['nombre']
+            nombre_u = nombre.upper()
+            kg = item['kg']
+            if nombre_u in costos_bom: costo_actual = costos_bom[nombre_u]
+            costo_para_calculo = costo_coyuntural if costo_coyuntural > 0 else costo_actual # El coyuntural reemplaza al actual
 
             regla_encontrada = reglas_excel.get(nombre_u, reglas_excel.get(nombre_base, {
                 "margen": MARGEN_DEFECTO, "envase": 0.0, "cod_flete": "FLETE LIM-AQP/TRUJ X KG", "peligroso": False
@@ -829,52 +1233,662 @@ def procesar_excel():
             precio_prov = precio_lima + flete_base
 
             resultados.append({
-                "nombre": nombre, "categoria": item['categoria'], "marca": item['marca'],
+                "nombre": nombre, "nombre_base": nombre_base, "categoria": item['categoria'], "marca": item['marca'],
                 "codigo": item['codigo'], "unidad_tipo": item['unidad_tipo'], "proveedor": item['proveedor'],
                 "margen": f"{round(regla['margen']*100, 1)}", "precio_lima": round(precio_lima, 2),
                 "precio_provincia": round(precio_prov, 2),
                 "presentacion": kg, "flete_status": "NO" if regla['cod_flete'] == "NINGUNO" else "SI",
+                "cod_flete": regla['cod_flete'], "peligroso": regla['peligroso'],
                 "costo_oculto": costo_op, "flete_oculto": flete_base, 
                 "costo_actual": costo_actual, "costo_coyuntural": costo_coyuntural
             })
 
         unicos = {}
         for r in resultados:
-            clave = f"{r['codigo']}_{r['nombre']}_{r['presentacion']}"
+            clave = clave_producto(r)
+            r['clave'] = clave
             if clave not in unicos or r['precio_lima'] > unicos[clave]['precio_lima']: unicos[clave] = r
                 
         lista_final = list(unicos.values())
-        lista_final.sort(key=lambda x: (
-            re.sub(r'\s*X?\s*\d+\.?\d*\s*(KG|G|L|LT|GALON|ML)\s*$', '', x['nombre'].upper()).strip(), -x['presentacion']
-        ))
+        lista_final.sort(key=lambda x: (x['nombre_base'], -x['presentacion']))
         return lista_final
     except Exception as e: 
         print(f"Error procesando datos: {e}")
         return []
 
-def actualizar_cache():
-    global CACHE_PRODUCTOS
-    CACHE_PRODUCTOS = procesar_excel()
+# =========================================================
+# 📡 GENERACIONES DE CACHE Y EVENTOS
+# =========================================================
+# Cada reconstrucción publica una "generación" (timestamp en ms) en FILE_EVENTOS.
+# El archivo es la fuente común para todos los procesos: cada uno lo vigila y,
+# si otro proceso publicó una generación más nueva, reconstruye su propia cache.
+# Publicar es leer-agregar-reemplazar: entre procesos se serializa con flock sobre
+# FILE_EVENTOS.lock, si no dos workers a la vez se pisan y uno pierde su evento.
+
+@contextlib.contextmanager
+def bloqueo_eventos():
+    with _LOCK_EVENTOS:
+        if fcntl is None:
+            yield
+            return
+        with open(f"{FILE_EVENTOS}.lock", 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try: yield
+            finally: fcntl.flock(f, fcntl.LOCK_UN)
+
+def leer_eventos():
+    if not os.path.exists(FILE_EVENTOS): return []
+    try:
+        with open(FILE_EVENTOS, 'r', encoding='utf-8') as f: return [json.loads(l) for l in f if l.strip()]
+    except: return []
 
-actualizar_cache()
+def calcular_cambios(anterior, nuevo):
+    previos = {p['clave']: p for p in anterior}
+    actuales = {p['clave']: p for p in nuevo}
+    cambios = [p for k, p in actuales.items() if previos.get(k) != p]
+    eliminados = [k for k in previos if k not in actuales]
+    return cambios, eliminados
+
+def publicar_evento(cambios, eliminados, completo=False, base=None):
+    with bloqueo_eventos():
+        eventos = leer_eventos()
+        ultima = eventos[-1]['generacion'] if eventos else 0
+        generacion = max(int(time.time() * 1000), ultima + 1)
+        # El diff se calculó contra la generación `base` de este proceso: si otro proceso
+        # publicó después, no sirve para quien ya está en esa generación intermedia
+        completo = completo or (base is not None and eventos and ultima != base)
+        completo = completo or len(cambios) + len(eliminados) > EVENTOS_MAX_CAMBIOS
+        eventos.append({
+            "generacion": generacion, "completo": completo,
+            "cambios": [] if completo else cambios, "eliminados": [] if completo else eliminados
+        })
+        eventos = eventos[-EVENTOS_MAX_HISTORIAL:]
+
+        tmp = f"{FILE_EVENTOS}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for e in eventos: f.write(json.dumps(e, ensure_ascii=False) + '\n')
+        os.replace(tmp, FILE_EVENTOS)
+    return generacion, eventos
+
+def notificar_eventos(eventos):
+    with _COND_EVENTOS:
+        _EVENTOS_RECIENTES[:] = eventos
+        _COND_EVENTOS.notify_all()
+
+def generacion_inicial():
+    eventos = leer_eventos()
+    ultima = eventos[-1]['generacion'] if eventos else 0
+    archivos = [FILE_PRECIOS_LINROS, FILE_PRECIOS_INTERINSUMO, FILE_REGLAS, FILE_DB_MANUAL, FILE_FORMULAS]
+    modificado = max((os.path.getmtime(a) for a in archivos if os.path.exists(a)), default=0)
+    # Si los datos cambiaron con el servidor apagado, los clientes deben recargar todo
+    if modificado * 1000 > ultima: return None
+    return ultima
+
+def actualizar_cache(publicar=True, generacion=None):
+    global CACHE_PRODUCTOS, GENERACION_CACHE
+    eventos = None
+    with _LOCK_CACHE, span("cache.reconstruir"):
+        # El vigía pudo ver nuestro propio evento antes de que terminara la reconstrucción
+        if generacion and generacion <= GENERACION_CACHE: return
+        with span("cache.procesar_excel"): nuevo = procesar_excel()
+        if publicar:
+            with span("cache.publicar_evento"):
+                cambios, eliminados = calcular_cambios(CACHE_PRODUCTOS, nuevo)
+                generacion, eventos = publicar_evento(cambios, eliminados, base=GENERACION_CACHE)
+        CACHE_PRODUCTOS = nuevo
+        GENERACION_CACHE = generacion if generacion is not None else GENERACION_CACHE
+    # Recién ahora: un cliente avisado que pida /api/cambios ya encuentra la generación nueva
+    if eventos is not None: notificar_eventos(eventos)
+
+def vigilar_eventos():
+    firma = None
+    while True:
+        try:
+            st = os.stat(FILE_EVENTOS)
+            actual = (st.st_mtime_ns, st.st_size)
+        except OSError: actual = None
+
+        if actual != firma:
+            firma = actual
+            eventos = leer_eventos()
+            if eventos and eventos[-1]['generacion'] > GENERACION_CACHE:
+                actualizar_cache(publicar=False, generacion=eventos[-1]['generacion'])
+            notificar_eventos(eventos)
+        time.sleep(SSE_POLL_SEG)
+
+def iniciar_vigia_eventos():
+    global _VIGIA_EVENTOS
+    if _VIGIA_EVENTOS is not None: return
+    with _LOCK_EVENTOS:
+        if _VIGIA_EVENTOS is None:
+            _VIGIA_EVENTOS = threading.Thread(target=vigilar_eventos, name="vigia-eventos", daemon=True)
+            _VIGIA_EVENTOS.start()
+
+_gen_inicial = generacion_inicial()
+if _gen_inicial is None:
+    actualizar_cache(publicar=False)
+    GENERACION_CACHE, _eventos_inicio = publicar_evento([], [], completo=True)
+    notificar_eventos(_eventos_inicio)
+else:
+    actualizar_cache(publicar=False, generacion=_gen_inicial)
+
+@app.before_request
+def asegurar_vigia(): iniciar_vigia_eventos()
+
+@app.before_request
+def abrir_traza():
+    if request.path.startswith(RUTAS_SIN_TRAZA): return
+    g.traza, g.token_traza = iniciar_traza(request.path)
+
+@app.after_request
+def cerrar_traza(response):
+    traza = g.pop('traza', None)
+    if traza is None: return response
+    ms = (time.perf_counter() - traza['t0']) * 1000
+    raices = [s for s in traza['spans'] if s['padre'] is None]
+    response.headers['X-Trace-Id'] = traza['id']
+    response.headers['Server-Timing'] = ", ".join([f"{s['nombre'].replace('.', '-')};dur={s['ms']}" for s in raices if s['ms'] is not None] + [f"total;dur={ms:.2f}"])
+
+    TRAZAS_RECIENTES.append({
+        "id": traza['id'], "ruta": traza['ruta'], "metodo": request.method, "status": response.status_code,
+        "ms": round(ms, 2), "spans": traza['spans']
+    })
+    cuerpo = request.get_json(silent=True) if request.method == 'POST' else None
+    consulta = request.args.get('q') if request.method == 'GET' else (cuerpo or {}).get('nombre')
+    registrar_consulta(request.path, consulta or "", getattr(g, 'resultados', None), ms)
+    grabar_trafico(request.method, request.path, urlencode(redactar(request.args.to_dict(flat=False)), doseq=True), cuerpo, response.status_code, ms)
+    return response
+
+@app.teardown_request
+def limpiar_traza(_error=None):
+    token = g.pop('token_traza', None)
+    if token is not None: _TRAZA_ACTUAL.reset(token)
 
 @app.route('/')
 def home(): return render_template('index.html')
 
-@app.route('/buscar')
-def buscar():
-    q = request.args.get('q', '').upper().strip()
-    if not q: return jsonify(CACHE_PRODUCTOS)
+# =========================================================
+# 🚚 MATRIZ DE FLETES POR DESTINO
+# =========================================================
+# Tarifa USD/kg por destino × código de flete × banda de kg. El precio de un
+# destino se calcula recién cuando alguien lo pide y queda memorizado hasta
+# la siguiente generación de cache (o hasta que cambie la matriz).
+# Si la matriz no tiene fila para el código de flete o ninguna banda cubre el kg,
+# el precio queda en None (no se cotiza con la tarifa Lima→AQP/TRU) y el hueco
+# aparece en /api/fletes/reporte.
+DESTINOS_FIJOS = {"LIMA": "precio_lima", "AQP/TRU": "precio_provincia"}
+
+_MATRIZ_FLETES = {}          # destino -> cod_flete -> {'desde': [...], 'bandas': [(desde, hasta, tarifa)]}
+_FIRMA_FLETES = None
+_PRECIOS_DESTINO = {}        # (generacion, firma) -> destino -> ({clave: precio}, huecos)
+_LOCK_FLETES = threading.Lock()
+
+def cargar_fletes_excel():
+    if not os.path.exists(FILE_FLETES): return {}
+    try:
+        if FILE_FLETES.endswith('.csv'): df = pd.read_csv(FILE_FLETES)
+        else: df = pd.read_excel(FILE_FLETES)
+        df.columns = [normalizar_texto(c) for c in df.columns]
+
+        col_destino = next((c for c in df.columns if 'DESTINO' in c), None)
+        col_flete = next((c for c in df.columns if c in ["COD. FLETE", "COD FLETE", "FLETE"]), None)
+        col_desde = next((c for c in df.columns if 'DESDE' in c), None)
+        col_hasta = next((c for c in df.columns if 'HASTA' in c), None)
+        col_tarifa = next((c for c in df.columns if 'TARIFA' in c or 'USD' in c), None)
+        if not (col_destino and col_flete and col_tarifa): return {}
+
+        df = df[df[col_destino].notna() & df[col_flete].notna()]
+        tarifa = pd.to_numeric(df[col_tarifa], errors='coerce')
+        desde = pd.to_numeric(df[col_desde], errors='coerce').fillna(0.0) if col_desde else pd.Series(0.0, index=df.index)
+        hasta = pd.to_numeric(df[col_hasta], errors='coerce').fillna(float('inf')) if col_hasta else pd.Series(float('inf'), index=df.index)
+
+        matriz = {}
+        for d, f, kd, kh, t in zip(texto_columna(df[col_destino]).tolist(), texto_columna(df[col_flete]).tolist(), desde.tolist(), hasta.tolist(), tarifa.tolist()):
+            if pd.isna(t): continue
+            matriz.setdefault(d, {}).setdefault(f, []).append((kd, kh, t))
+        for por_codigo in matriz.values():
+            for f, bandas in por_codigo.items():
+                bandas.sort()
+                por_codigo[f] = {'desde': [b[0] for b in bandas], 'bandas': bandas}
+        return matriz
+    except Exception as e: return {}
+
+def matriz_fletes():
+    global _MATRIZ_FLETES, _FIRMA_FLETES
+    firma = firma_archivo(FILE_FLETES)
+    if firma != _FIRMA_FLETES:
+        with _LOCK_FLETES:
+            if firma != _FIRMA_FLETES:
+                _MATRIZ_FLETES, _FIRMA_FLETES = cargar_fletes_excel(), firma
+    return _MATRIZ_FLETES, _FIRMA_FLETES
+
+def tarifa_flete(por_codigo, cod_flete, kg):
+    if cod_flete == "NINGUNO": return 0.0
+    tabla = por_codigo.get(cod_flete)
+    if tabla:
+        i = bisect.bisect_right(tabla['desde'], kg) - 1
+        if i >= 0 and kg <= tabla['bandas'][i][1]: return tabla['bandas'][i][2]
+    return None
+
+def cotizar_destino(destino, generacion, productos):
+    # -> ({clave: precio o None}, huecos) o None si el destino no existe
+    destino = destino.upper().strip()
+    if destino in DESTINOS_FIJOS:
+        campo = DESTINOS_FIJOS[destino]
+        return {p['clave']: p[campo] for p in productos}, []
+
+    matriz, firma = matriz_fletes()
+    if destino not in matriz: return None
+    memo = _PRECIOS_DESTINO.get((generacion, firma))
+    if memo is None:
+        memo = {}
+        _PRECIOS_DESTINO.clear()
+        _PRECIOS_DESTINO[(generacion, firma)] = memo
+
+    if destino not in memo:
+        por_codigo = matriz[destino]
+        precios, huecos = {}, {}
+        for p in productos:
+            flete = tarifa_flete(por_codigo, p['cod_flete'], p['presentacion'])
+            if flete is None:
+                precios[p['clave']] = None
+                hueco = (p['cod_flete'], p['presentacion'])
+                huecos[hueco] = huecos.get(hueco, 0) + 1
+                continue
+            if p['peligroso']: flete += RECARGO_PELIGROSO
+            precios[p['clave']] = round(p['precio_lima'] + flete, 2)
+        memo[destino] = (precios, [{"cod_flete": f, "kg": kg, "productos": n} for (f, kg), n in sorted(huecos.items())])
+    return memo[destino]
+
+def precios_destino(destino, generacion, productos):
+    cotizacion = cotizar_destino(destino, generacion, productos)
+    return cotizacion[0] if cotizacion else None
+
+def huecos_fletes():
+    generacion, productos = GENERACION_CACHE, CACHE_PRODUCTOS
+    huecos = {}
+    for destino in sorted(matriz_fletes()[0]):
+        cotizacion = cotizar_destino(destino, generacion, productos)
+        if cotizacion and cotizacion[1]: huecos[destino] = cotizacion[1]
+    return huecos
+
+def indices_filtrados(productos, q):
+    q = q.upper().strip()
+    if not q: return None
     palabras = q.split()
     
     res = []
-    for p in CACHE_PRODUCTOS:
+    for i, p in enumerate(productos):
         nombre_match = all(pal in p['nombre'].upper() for pal in palabras)
         codigo_match = all(pal in p['codigo'].upper() for pal in palabras)
         if nombre_match or codigo_match:
-            res.append(p)
-            
-    return jsonify(res)
+            res.append(i)
+    return res
+
+def filtrar_productos(productos, q):
+    indices = indices_filtrados(productos, q)
+    if indices is None: return productos
+    return [productos[i] for i in indices]
+
+def buscar_productos(q, destino=""):
+    generacion, productos = GENERACION_CACHE, CACHE_PRODUCTOS
+    res = filtrar_productos(productos, q)
+    if not destino.strip(): return res, None
+
+    precios = precios_destino(destino, generacion, productos)
+    if precios is None: return None, f"Destino desconocido: {destino}"
+    destino = destino.upper().strip()
+    return [dict(p, destino=destino, precio_destino=precios.get(p['clave'])) for p in res], None
+
+# =========================================================
+# 📦 FORMATOS BINARIOS (MESSAGEPACK / ARROW IPC)
+# =========================================================
+# Para integraciones (ERP, reportes) que bajan el catálogo entero. Se arma una
+# vista columnar por generación de cache y se codifica desde ahí, sin pasar
+# por un dict por fila. Los textos van con diccionario (valores únicos + índices).
+# msgpack y pyarrow son opcionales: sin ellos se responde 406.
+FORMATOS_BINARIOS = {"msgpack": "application/msgpack", "arrow": "application/vnd.apache.arrow.stream"}
+# Esquema fijo (mismo orden que las filas de procesar_excel): no se deduce de la
+# primera fila porque el catálogo vacío (procesar_excel() ante un error) no tiene
+ESQUEMA_CATALOGO = [
+    ("nombre", "texto"), ("nombre_base", "texto"), ("categoria", "texto"), ("marca", "texto"),
+    ("codigo", "texto"), ("unidad_tipo", "texto"), ("proveedor", "texto"), ("margen", "texto"),
+    ("precio_lima", "decimal"), ("precio_provincia", "decimal"), ("presentacion", "decimal"),
+    ("flete_status", "texto"), ("cod_flete", "texto"), ("peligroso", "booleano"),
+    ("costo_oculto", "decimal"), ("flete_oculto", "decimal"), ("costo_actual", "decimal"),
+    ("costo_coyuntural", "decimal"), ("clave", "texto"),
+]
+MIME_A_FORMATO = {"application/msgpack": "msgpack", "application/x-msgpack": "msgpack", "application/vnd.apache.arrow.stream": "arrow"}
+_COLUMNAR = {}  # generacion -> {'campos', 'columnas', 'textos', 'arrow', 'bytes'}
+
+def formato_binario(formato, accept):
+    formato = (formato or "").lower()
+    if formato: return formato if formato in FORMATOS_BINARIOS else None
+    for mime, _ in accept:
+        if mime in MIME_A_FORMATO: return MIME_A_FORMATO[mime]
+        if mime in ("application/json", "*/*"): return None
+    return None
+
+def catalogo_columnar(generacion, productos):
+    col = _COLUMNAR.get(generacion)
+    if col is None:
+        campos = [c for c, _ in ESQUEMA_CATALOGO]
+        col = {
+            "campos": campos, "columnas": {c: [p[c] for p in productos] for c in campos},
+            "filas": len(productos), "textos": set(c for c, tipo in ESQUEMA_CATALOGO if tipo == "texto"),
+            "arrow": None, "bytes": {},
+        }
+        _COLUMNAR.clear()
+        _COLUMNAR[generacion] = col
+    return col
+
+def codificar_msgpack(col, campos, indices=None, extra=None):
+    import msgpack
+    datos = {}
+    for c in campos:
+        valores = col["columnas"][c] if indices is None else [col["columnas"][c][i] for i in indices]
+        if c in col["textos"]:
+            diccionario = {}
+            posiciones = [diccionario.setdefault(v, len(diccionario)) for v in valores]
+            datos[c] = {"diccionario": list(diccionario), "indices": posiciones}
+        else: datos[c] = valores
+    datos.update(extra or {})
+    filas = col["filas"] if indices is None else len(indices)
+    return msgpack.packb({"filas": filas, "campos": campos + list(extra or {}), "columnas": datos}, use_bin_type=True)
+
+def tabla_arrow(col):
+    import pyarrow as pa
+    if col["arrow"] is None:
+        tipos = {"texto": pa.string(), "decimal": pa.float64(), "booleano": pa.bool_()}
+        arrays = []
+        for c, tipo in ESQUEMA_CATALOGO:
+            arr = pa.array(col["columnas"][c], type=tipos[tipo])
+            arrays.append(arr.dictionary_encode() if c in col["textos"] else arr)
+        col["arrow"] = pa.Table.from_arrays(arrays, names=col["campos"])
+    return col["arrow"]
+
+def codificar_arrow(col, campos, indices=None, extra=None):
+    import pyarrow as pa
+    tabla = tabla_arrow(col).select(campos)
+    if indices is not None: tabla = tabla.take(pa.array(indices, type=pa.int64()))
+    for nombre, valores in (extra or {}).items(): tabla = tabla.append_column(nombre, pa.array(valores, type=pa.float64()))
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, tabla.schema) as writer: writer.write_table(tabla)
+    return sink.getvalue().to_pybytes()
+
+CODIFICADORES = {"msgpack": codificar_msgpack, "arrow": codificar_arrow}
+
+def respuesta_binaria(formato, col, campos, indices=None, extra=None, memo=None):
+    # memo: clave para guardar el resultado completo de esta generación
+    try:
+        if memo and memo in col["bytes"]: cuerpo = col["bytes"][memo]
+        else:
+            cuerpo = CODIFICADORES[formato](col, campos, indices, extra)
+            if memo: col["bytes"][memo] = cuerpo
+    except ImportError:
+        return None, (f"Formato {formato} no disponible en este servidor (falta la librería)", 406)
+    return cuerpo, None
+
+def buscar_binario(formato, q, destino=""):
+    generacion, productos = GENERACION_CACHE, CACHE_PRODUCTOS
+    col = catalogo_columnar(generacion, productos)
+    indices = indices_filtrados(productos, q)
+
+    extra = None
+    if destino.strip():
+        precios = precios_destino(destino, generacion, productos)
+        if precios is None: return None, (f"Destino desconocido: {destino}", 400)
+        claves = col["columnas"]["clave"] if indices is None else [col["columnas"]["clave"][i] for i in indices]
+        extra = {"precio_destino": [precios.get(k) for k in claves]}
+
+    memo = ("buscar", formato) if indices is None and extra is None else None
+    return respuesta_binaria(formato, col, col["campos"], indices, extra, memo)
+
+@app.route('/buscar')
+def buscar():
+    formato = formato_binario(request.args.get('formato'), request.accept_mimetypes)
+    if formato:
+        with span("buscar.serializar", formato=formato):
+            cuerpo, error = buscar_binario(formato, request.args.get('q', ''), request.args.get('destino', ''))
+        if error: return jsonify({"error": error[0]}), error[1]
+        return Response(cuerpo, mimetype=FORMATOS_BINARIOS[formato])
+
+    with span("buscar.filtrar"):
+        res, error = buscar_productos(request.args.get('q', ''), request.args.get('destino', ''))
+    if error: return jsonify({"error": error}), 400
+    g.resultados = len(res)
+    with span("buscar.serializar"): return jsonify(res)
+
+@app.route('/api/destinos')
+def destinos():
+    return jsonify(list(DESTINOS_FIJOS) + sorted(d for d in matriz_fletes()[0] if d not in DESTINOS_FIJOS))
+
+# Con el servidor Flask cada cliente conectado ocupa un hilo (y con workers
+# síncronos, un worker entero) aunque esté ocioso. Para cientos de pestañas
+# abiertas usar el modo async (app_async.py), que atiende esta ruta en el event loop.
+@app.route('/api/eventos')
+def eventos():
+    try: ultima = int(request.args.get('desde') or request.headers.get('Last-Event-ID') or GENERACION_CACHE)
+    except ValueError: ultima = GENERACION_CACHE
+
+    def stream(ultima):
+        yield f"retry: 3000\nevent: generacion\ndata: {json.dumps({'generacion': GENERACION_CACHE})}\n\n"
+        while True:
+            with _COND_EVENTOS:
+                pendientes = [e for e in _EVENTOS_RECIENTES if e['generacion'] > ultima]
+                if not pendientes:
+                    _COND_EVENTOS.wait(SSE_HEARTBEAT_SEG)
+                    pendientes = [e for e in _EVENTOS_RECIENTES if e['generacion'] > ultima]
+            if not pendientes:
+                yield ": ping\n\n"
+                continue
+            for e in pendientes:
+                ultima = e['generacion']
+                yield f"id: {ultima}\nevent: precios\ndata: {json.dumps(e, ensure_ascii=False)}\n\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(stream(ultima)), mimetype='text/event-stream', headers=headers)
+
+# =========================================================
+# 🧬 FAMILIAS: TODAS LAS PRESENTACIONES LADO A LADO
+# =========================================================
+# Agrupa el catálogo ya costeado (con precios y las presentaciones inyectadas
+# desde las reglas), no las variantes crudas de Odoo de INDICE_FAMILIAS.
+_FAMILIAS_CATALOGO = {}  # generacion -> {nombre_base: [productos]}
+
+def familias_catalogo():
+    generacion, productos = GENERACION_CACHE, CACHE_PRODUCTOS
+    familias = _FAMILIAS_CATALOGO.get(generacion)
+    if familias is None:
+        familias = {}
+        for p in productos: familias.setdefault(p['nombre_base'], []).append(p)
+        for presentaciones in familias.values(): presentaciones.sort(key=lambda p: p['presentacion'])
+        _FAMILIAS_CATALOGO.clear()
+        _FAMILIAS_CATALOGO[generacion] = familias
+    return familias
+
+@app.route('/api/familia/<path:base>')
+def familia(base):
+    nombre_base = calcular_nombre_base(base)
+    presentaciones = familias_catalogo().get(nombre_base)
+    if not presentaciones: return jsonify({"error": "Familia no encontrada"}), 404
+
+    return jsonify({
+        "nombre_base": nombre_base,
+        "presentaciones": [{
+            "nombre": p['nombre'], "codigo": p['codigo'], "presentacion": p['presentacion'], "margen": p['margen'],
+            "precio_lima": p['precio_lima'], "precio_provincia": p['precio_provincia'], "flete_status": p['flete_status'],
+        } for p in presentaciones]
+    })
+
+# =========================================================
+# 📶 CATÁLOGO OFFLINE (SINCRONIZACIÓN DELTA)
+# =========================================================
+# El navegador guarda estos campos en IndexedDB y busca localmente.
+CAMPOS_PUBLICOS = [
+    "clave", "nombre", "categoria", "marca", "codigo", "unidad_tipo", "proveedor", "margen",
+    "precio_lima", "precio_provincia", "presentacion", "flete_status",
+]
+
+def producto_publico(p):
+    return {c: p[c] for c in CAMPOS_PUBLICOS}
+
+# Une los eventos en (desde, generacion]. None = el cliente está muy atrasado y necesita snapshot completo
+def delta_desde(desde, generacion, eventos):
+    if desde == generacion: return {}, set()
+    if not any(e['generacion'] == desde for e in eventos): return None
+
+    cambios, eliminados = {}, set()
+    for e in eventos:
+        if e['generacion'] <= desde or e['generacion'] > generacion: continue
+        if e['completo']: return None
+        for p in e['cambios']:
+            cambios[p['clave']] = p
+            eliminados.discard(p['clave'])
+        for clave in e['eliminados']:
+            cambios.pop(clave, None)
+            eliminados.add(clave)
+    return cambios, eliminados
+
+@app.route('/api/cambios')
+def cambios():
+    try: desde = int(request.args.get('desde', 0) or 0)
+    except ValueError: desde = 0
+    generacion, productos = GENERACION_CACHE, CACHE_PRODUCTOS
+
+    delta = delta_desde(desde, generacion, _EVENTOS_RECIENTES or leer_eventos()) if desde else None
+    if delta is None:
+        return jsonify({"generacion": generacion, "completo": True, "productos": [producto_publico(p) for p in productos]})
+
+    cambiados, eliminados = delta
+    return jsonify({
+        "generacion": generacion, "completo": False,
+        "cambios": [producto_publico(p) for p in cambiados.values()], "eliminados": sorted(eliminados)
+    })
+
+# =========================================================
+# 📤 EXPORTACIÓN DE LISTA DE PRECIOS (CSV / XLSX)
+# =========================================================
+COLUMNAS_EXPORTACION = [
+    ("Producto", "nombre"), ("Código", "codigo"), ("Categoría", "categoria"), ("Marca", "marca"),
+    ("Proveedor", "proveedor"), ("Presentación (kg)", "presentacion"),
+    ("Precio Lima (USD)", "precio_lima"), ("Precio AQP/TRU (USD)", "precio_provincia"), ("Flete", "flete_status"),
+]
+FILAS_POR_BLOQUE = 500
+FORMATOS_EXPORTACION = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+}
+
+def indices_exportacion(productos, categoria="", proveedor=""):
+    categoria, proveedor = categoria.upper().strip(), proveedor.upper().strip()
+    for i, p in enumerate(productos):
+        if categoria and p['categoria'] != categoria: continue
+        if proveedor and p['proveedor'] != proveedor: continue
+        yield i
+
+def filtrar_exportacion(productos, categoria="", proveedor=""):
+    return (productos[i] for i in indices_exportacion(productos, categoria, proveedor))
+
+def generar_csv(productos):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')  # BOM para que Excel respete tildes
+    writer.writerow([titulo for titulo, _ in COLUMNAS_EXPORTACION])
+    for i, p in enumerate(productos, 1):
+        writer.writerow([p[campo] for _, campo in COLUMNAS_EXPORTACION])
+        if i % FILAS_POR_BLOQUE == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0); buffer.truncate(0)
+    yield buffer.getvalue().encode('utf-8')
+
+def escribir_xlsx(productos, destino):
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Lista de Precios")
+    ws.append([titulo for titulo, _ in COLUMNAS_EXPORTACION])
+    for p in productos: ws.append([p[campo] for _, campo in COLUMNAS_EXPORTACION])
+    wb.save(destino)
+
+def escribir_exportacion(formato, productos, destino):
+    if formato == 'xlsx': return escribir_xlsx(productos, destino)
+    with open(destino, 'wb') as f:
+        for bloque in generar_csv(productos): f.write(bloque)
+
+def leer_en_bloques(ruta, tam=64 * 1024):
+    with open(ruta, 'rb') as f:
+        while True:
+            bloque = f.read(tam)
+            if not bloque: break
+            yield bloque
+
+def borrar_archivo(ruta):
+    try: os.remove(ruta)
+    except OSError: pass
+
+def exportacion_completa(formato):
+    # Devuelve el archivo ya abierto: si otro worker con una generación más nueva
+    # lo borra antes del envío, el contenido sigue accesible por el descriptor
+    # Se lee la generación antes que la lista: nunca queda data vieja con nombre de generación nueva
+    generacion, productos = GENERACION_CACHE, CACHE_PRODUCTOS
+    ext = FORMATOS_EXPORTACION[formato][1]
+    ruta = os.path.join(DIR_EXPORTACIONES, f"lista_precios_{generacion}.{ext}")
+    try: return open(ruta, 'rb')
+    except FileNotFoundError: pass
+
+    os.makedirs(DIR_EXPORTACIONES, exist_ok=True)
+    tmp = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    escribir_exportacion(formato, productos, tmp)
+    archivo = open(tmp, 'rb')
+    os.replace(tmp, ruta)
+
+    # Solo generaciones anteriores: un worker atrasado no debe borrar el archivo que otro está por enviar
+    for viejo in os.listdir(DIR_EXPORTACIONES):
+        m = re.fullmatch(rf"lista_precios_(\d+)\.{ext}", viejo)
+        if m and int(m.group(1)) < generacion: borrar_archivo(os.path.join(DIR_EXPORTACIONES, viejo))
+    return archivo
+
+@app.route('/api/exportar')
+def exportar():
+    categoria, proveedor = request.args.get('categoria', ''), request.args.get('proveedor', '')
+    binario = formato_binario(request.args.get('formato'), request.accept_mimetypes)
+    if binario:
+        generacion, productos = GENERACION_CACHE, CACHE_PRODUCTOS
+        col = catalogo_columnar(generacion, productos)
+        campos = [campo for _, campo in COLUMNAS_EXPORTACION]
+        filtrado = categoria or proveedor
+        indices = list(indices_exportacion(productos, categoria, proveedor)) if filtrado else None
+        with span("exportar.serializar", formato=binario):
+            cuerpo, error = respuesta_binaria(binario, col, campos, indices, memo=None if filtrado else ("exportar", binario))
+        if error: return jsonify({"error": error[0]}), error[1]
+        return Response(cuerpo, mimetype=FORMATOS_BINARIOS[binario])
+
+    formato = request.args.get('formato', 'csv').lower()
+    if formato not in FORMATOS_EXPORTACION: return jsonify({"error": "Formato no soportado (csv, xlsx, msgpack o arrow)"}), 400
+    mimetype, ext = FORMATOS_EXPORTACION[formato]
+    nombre_archivo = f"lista_precios.{ext}"
+
+    if not categoria and not proveedor:
+        with span("exportar.archivo_generacion", formato=formato): archivo = exportacion_completa(formato)
+        return send_file(archivo, mimetype=mimetype, as_attachment=True, download_name=nombre_archivo)
+
+    headers = {"Content-Disposition": f'attachment; filename="{nombre_archivo}"'}
+    productos = filtrar_exportacion(CACHE_PRODUCTOS, categoria, proveedor)
+    if formato == 'csv':
+        return Response(stream_with_context(generar_csv(productos)), mimetype=mimetype, headers=headers)
+
+    # XLSX es un zip: se arma en disco en modo write-only y se envía en bloques
+    fd, tmp = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+    try:
+        with span("exportar.serializar", formato=formato): escribir_xlsx(productos, tmp)
+    except Exception:
+        borrar_archivo(tmp)
+        raise
+    # call_on_close corre aunque el generador nunca arranque (HEAD, cliente que corta antes)
+    respuesta = Response(leer_en_bloques(tmp), mimetype=mimetype, headers=headers)
+    respuesta.call_on_close(lambda: borrar_archivo(tmp))
+    return respuesta
 
 @app.route('/subir-precios/<empresa>', methods=['POST'])
 def subir_precios(empresa):
@@ -891,7 +1905,52 @@ def subir_reglas():
     f = request.files['archivo']
     f.save(FILE_REGLAS)
     actualizar_cache() 
-    return jsonify({"mensaje": "✅ Reglas Maestras actualizadas"})
+    r = REPORTE_REGLAS
+    return jsonify({
+        "mensaje": f"✅ Reglas Maestras actualizadas ({r.get('reglas', 0)} reglas, {len(r.get('rechazadas', []))} filas rechazadas, {len(r.get('advertencias', []))} advertencias)",
+        "reporte": r
+    })
+
+@app.route('/subir-formulas', methods=['POST'])
+def subir_formulas():
+    if request.form.get('token') != ADMIN_SECRET: return jsonify({"error": "No autorizado"}), 403
+    f = request.files['archivo']
+    f.save(FILE_FORMULAS)
+    actualizar_cache() 
+    r = REPORTE_BOM
+    return jsonify({
+        "mensaje": f"✅ Recetas actualizadas ({r.get('recetas', 0)} productos, {len(r.get('ciclos', []))} en ciclo, {len(r.get('faltantes', {}))} con componentes faltantes)",
+        "reporte": r
+    })
+
+@app.route('/api/bom/reporte')
+def reporte_bom():
+    if request.args.get('token') != ADMIN_SECRET: return jsonify({"error": "No autorizado"}), 403
+    return jsonify(REPORTE_BOM)
+
+@app.route('/api/admin/consultas-lentas')
+def consultas_lentas():
+    if request.args.get('token') != ADMIN_SECRET: return jsonify({"error": "No autorizado"}), 403
+    n = request.args.get('n', 20, type=int)
+    entradas = sorted(leer_consultas_lentas(), key=lambda e: e['ms'], reverse=True)
+    return jsonify({"umbral_ms": UMBRAL_LENTAS_MS, "total": len(entradas), "consultas": entradas[:n]})
+
+@app.route('/api/admin/trazas')
+def trazas():
+    if request.args.get('token') != ADMIN_SECRET: return jsonify({"error": "No autorizado"}), 403
+    n = request.args.get('n', 20, type=int)
+    return jsonify(list(TRAZAS_RECIENTES)[-n:][::-1])
+
+@app.route('/api/fletes/reporte')
+def reporte_fletes():
+    if request.args.get('token') != ADMIN_SECRET: return jsonify({"error": "No autorizado"}), 403
+    huecos = huecos_fletes()
+    return jsonify({"destinos": len(matriz_fletes()[0]), "con_huecos": len(huecos), "huecos": huecos})
+
+@app.route('/api/reglas/reporte')
+def reporte_reglas():
+    if request.args.get('token') != ADMIN_SECRET: return jsonify({"error": "No autorizado"}), 403
+    return jsonify(REPORTE_REGLAS)
 
 @app.route('/api/editar-margen', methods=['POST'])
 def editar_margen():
@@ -913,8 +1972,7 @@ def editar_costo_coyuntural():
     if nuevo_costo <= 0:
         if d['nombre'] in datos and 'costo_coyuntural' in datos[d['nombre']]:
             del datos[d['nombre']]['costo_coyuntural']
-            with open(FILE_DB_MANUAL, 'w', encoding='utf-8') as f:
-                json.dump(datos, f, ensure_ascii=False, indent=4)
+            escribir_db_manual(datos)
     else:
         guardar_db_manual(d['nombre'], 'costo_coyuntural', nuevo_costo)
         
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import time
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import app as lista
+
+# =========================================================
+# ⚡ MODO ASYNC (OPCIONAL)
+# =========================================================
+# Uso:  uvicorn app_async:app --host 0.0.0.0 --port 5000 --workers 4
+#
+# /buscar y /api/eventos corren en el event loop leyendo la cache inmutable
+# (actualizar_cache() siempre reemplaza la lista, nunca la modifica).
+# Todo lo que bloquea (subidas de Excel, reconstrucciones, escritura de
+# db_manual.json) sigue en la app Flask, montada en un pool de hilos.
+
+WORKERS_BLOQUEANTES = 8
+
+_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="async-io")
+_JSON_CATALOGO = {}  # generacion -> bytes del catálogo completo ya serializado
+
+def json_bytes(datos):
+    return json.dumps(datos, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+async def catalogo_completo():
+    # Leer la generación ANTES que la lista: así nunca se guarda data vieja bajo una generación nueva
+    generacion = lista.GENERACION_CACHE
+    productos = lista.CACHE_PRODUCTOS
+    cuerpo = _JSON_CATALOGO.get(generacion)
+    if cuerpo is None:
+        cuerpo = await asyncio.get_running_loop().run_in_executor(_POOL, json_bytes, productos)
+        _JSON_CATALOGO.clear()
+        _JSON_CATALOGO[generacion] = cuerpo
+    return cuerpo
+
+async def buscar(request):
+    t, llegada = time.perf_counter(), time.time()
+    respuesta, resultados = await _buscar(request)
+    q, ms = request.query_params.get('q', ''), (time.perf_counter() - t) * 1000
+    _POOL.submit(lista.registrar_consulta, '/buscar', q, resultados, ms)  # Escribe a disco: fuera del loop
+    if lista.FILE_GRABACION: _POOL.submit(lista.grabar_trafico, 'GET', '/buscar', request.url.query, None, respuesta.status_code, ms, llegada)
+    return respuesta
+
+async def _buscar(request):
+    q, destino = request.query_params.get('q', ''), request.query_params.get('destino', '')
+    accept = parse_accept_header(request.headers.get('accept'), MIMEAccept)
+    formato = lista.formato_binario(request.query_params.get('formato'), accept)
+    if formato:
+        cuerpo, error = await asyncio.get_running_loop().run_in_executor(_POOL, lista.buscar_binario, formato, q, destino)
+        if error: return Response(json_bytes({"error": error[0]}), status_code=error[1], media_type='application/json'), None
+        return Response(cuerpo, media_type=lista.FORMATOS_BINARIOS[formato]), None
+
+    if not q.strip() and not destino.strip():
+        return Response(await catalogo_completo(), media_type='application/json'), len(lista.CACHE_PRODUCTOS)
+
+    # Filtrar es un recorrido O(n) y el primer pedido de un destino calcula sus precios:
+    # ambos, y la serialización, van al pool para no frenar el loop
+    cuerpo, resultados, error = await asyncio.get_running_loop().run_in_executor(_POOL, buscar_serializado, q, destino)
+    if error: return Response(json_bytes({"error": error}), status_code=400, media_type='application/json'), None
+    return Response(cuerpo, media_type='application/json'), resultados
+
+def buscar_serializado(q, destino):
+    if destino.strip():
+        res, error = lista.buscar_productos(q, destino)
+        if error: return None, None, error
+    else: res = lista.filtrar_productos(lista.CACHE_PRODUCTOS, q)
+    return json_bytes(res), len(res), None
+
+# =========================================================
+# 📡 SSE SOBRE EL EVENT LOOP
+# =========================================================
+# Un solo hilo espera en la Condition de app.py y despierta a todas las
+# conexiones con un asyncio.Event: cientos de clientes ociosos no ocupan hilos.
+# Es un hilo daemon propio: en _POOL ocuparía un worker para siempre y
+# el apagado esperaría a que venza el heartbeat.
+
+class Difusor:
+    def __init__(self, loop):
+        self._loop = loop
+        self._cambio = asyncio.Event()
+
+    def _ultima(self):
+        return lista._EVENTOS_RECIENTES[-1]['generacion'] if lista._EVENTOS_RECIENTES else 0
+
+    def _vigilar(self):
+        conocida = self._ultima()
+        while True:
+            with lista._COND_EVENTOS:
+                lista._COND_EVENTOS.wait_for(lambda: self._ultima() != conocida, lista.SSE_HEARTBEAT_SEG)
+                nueva = self._ultima()
+            if nueva == conocida: continue
+            conocida = nueva
+            try: self._loop.call_soon_threadsafe(self._despertar)
+            except RuntimeError: return  # Loop cerrado: el servidor se está apagando
+
+    def _despertar(self):
+        evento, self._cambio = self._cambio, asyncio.Event()
+        evento.set()
+
+    def iniciar(self):
+        threading.Thread(target=self._vigilar, name="async-sse", daemon=True).start()
+
+    async def esperar(self, timeout):
+        try: await asyncio.wait_for(self._cambio.wait(), timeout)
+        except asyncio.TimeoutError: pass
+
+DIFUSOR = None
+
+async def eventos(request):
+    try: ultima = int(request.query_params.get('desde') or request.headers.get('last-event-id') or lista.GENERACION_CACHE)
+    except ValueError: ultima = lista.GENERACION_CACHE
+
+    async def stream(ultima):
+        yield f"retry: 3000\nevent: generacion\ndata: {json.dumps({'generacion': lista.GENERACION_CACHE})}\n\n"
+        while True:
+            pendientes = [e for e in lista._EVENTOS_RECIENTES if e['generacion'] > ultima]
+            if not pendientes:
+                await DIFUSOR.esperar(lista.SSE_HEARTBEAT_SEG)
+                pendientes = [e for e in lista._EVENTOS_RECIENTES if e['generacion'] > ultima]
+            if not pendientes:
+                yield ": ping\n\n"
+                continue
+            for e in pendientes:
+                ultima = e['generacion']
+                yield f"id: {ultima}\nevent: precios\ndata: {json.dumps(e, ensure_ascii=False)}\n\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(stream(ultima), media_type='text/event-stream', headers=headers)
+
+@contextlib.asynccontextmanager
+async def ciclo_de_vida(_app):
+    global DIFUSOR
+    lista.iniciar_vigia_eventos()
+    DIFUSOR = Difusor(asyncio.get_running_loop())
+    DIFUSOR.iniciar()
+    yield
+
+app = Starlette(
+    routes=[
+        Route('/buscar', buscar),
+        Route('/api/eventos', eventos),
+        Mount('/', WSGIMiddleware(lista.app, workers=WORKERS_BLOQUEANTES)),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=ciclo_de_vida,
+)
@@ -0,0 +1,76 @@
+import argparse
+import gzip
+import json
+import time
+
+import msgpack
+import pyarrow as pa
+from flask import jsonify
+
+import app
+
+# =========================================================
+# ⏱️ BENCHMARK: JSON vs MESSAGEPACK vs ARROW IPC
+# =========================================================
+# Uso: python bench_formatos.py --factor 1 20
+# Mide tamaño (crudo y gzip) y tiempos de codificar/decodificar el catálogo
+# completo. --factor replica el catálogo para simular uno más grande.
+
+def catalogo_escalado(factor):
+    if factor == 1: return app.CACHE_PRODUCTOS
+    productos = []
+    for i in range(factor):
+        for p in app.CACHE_PRODUCTOS:
+            productos.append(dict(p, nombre=f"{p['nombre']} V{i}", clave=f"{p['clave']}_V{i}"))
+    return productos
+
+def medir(fn, repeticiones):
+    mejor, resultado = float('inf'), None
+    for _ in range(repeticiones):
+        t = time.perf_counter()
+        resultado = fn()
+        mejor = min(mejor, time.perf_counter() - t)
+    return mejor * 1000, resultado
+
+def main():
+    parser = argparse.ArgumentParser(description="Tamaño y velocidad de los formatos de /buscar")
+    parser.add_argument("--factor", type=int, nargs="+", default=[1, 20])
+    parser.add_argument("--repeticiones", type=int, default=5)
+    args = parser.parse_args()
+
+    for factor in args.factor:
+        productos = catalogo_escalado(factor)
+        campos = list(productos[0])
+
+        def columnar():
+            app._COLUMNAR.clear()
+            return app.catalogo_columnar(-factor, productos)
+
+        def jsonify_catalogo():
+            with app.app.app_context(): return jsonify(productos).get_data()
+
+        def arrow_frio():
+            col = columnar()
+            return app.codificar_arrow(col, campos)
+
+        casos = [
+            ("jsonify", jsonify_catalogo, json.loads),
+            ("msgpack filas", lambda: msgpack.packb(productos), msgpack.unpackb),
+            ("msgpack columnar", lambda: app.codificar_msgpack(columnar(), campos), msgpack.unpackb),
+            ("arrow ipc", arrow_frio, lambda b: pa.ipc.open_stream(b).read_all()),
+        ]
+
+        print(f"\n{len(productos)} productos (factor {factor})")
+        print(f"{'formato':<18} {'bytes':>10} {'gzip':>9} {'codificar ms':>13} {'decodificar ms':>15}")
+        for nombre, codificar, decodificar in casos:
+            t_cod, cuerpo = medir(codificar, args.repeticiones)
+            t_dec, _ = medir(lambda: decodificar(cuerpo), args.repeticiones)
+            print(f"{nombre:<18} {len(cuerpo):>10} {len(gzip.compress(cuerpo)):>9} {t_cod:>13.2f} {t_dec:>15.2f}")
+
+        col = columnar()
+        app.codificar_arrow(col, campos)
+        t_cache, _ = medir(lambda: app.codificar_arrow(col, campos), args.repeticiones)
+        print(f"{'arrow (tabla ya armada)':<29} {'':>9} {t_cache:>13.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import random
+import re
+import time
+
+import pandas as pd
+
+import app
+
+# =========================================================
+# ⏱️ BENCHMARK: COMPILADOR DE REGLAS vs LOADER FILA POR FILA
+# =========================================================
+# Uso: python bench_reglas.py --factor 20
+# Arma una hoja de reglas sintética a partir de los productos de data_margenes.xlsx
+# y compara el loader anterior (iterrows) con compilar_reglas() + reglas_desde_tabla().
+
+def cargar_reglas_iterrows(df):
+    # Copia del cargar_reglas_excel() anterior, sin la lectura del archivo
+    df = df.copy()
+    df.columns = [app.normalizar_texto(c) for c in df.columns]
+
+    col_prod = "PRODUCTO" if "PRODUCTO" in df.columns else None
+    col_margen = "MARGEN" if "MARGEN" in df.columns else None
+    col_envase = next((c for c in df.columns if 'ENVASE' in c), None)
+    col_flete = next((c for c in df.columns if c in ["COD. FLETE", "COD FLETE", "FLETE"]), None)
+    col_peligroso = "PELIGROSO" if "PELIGROSO" in df.columns else None
+    col_manual = next((c for c in df.columns if 'FABRICACION' in c or 'ADICIONAL' in c or 'MANUAL' in c), None)
+
+    reglas = {}
+    if not col_prod: return {}
+
+    for _, row in df.iterrows():
+        if pd.isna(row[col_prod]): continue
+        nombre = str(row[col_prod]).upper().strip()
+
+        m = app.MARGEN_DEFECTO
+        if col_margen and not pd.isna(row[col_margen]):
+            val = pd.to_numeric(row[col_margen], errors='coerce')
+            if not pd.isna(val): m = val / 100 if val > 1 else val
+
+        e = 0.0
+        if col_envase and not pd.isna(row[col_envase]):
+            val_str = str(row[col_envase]).replace('$', '').replace(',', '').strip()
+            val_e = pd.to_numeric(val_str, errors='coerce')
+            if not pd.isna(val_e): e = val_e
+
+        f = "FLETE LIM-AQP/TRUJ X KG"
+        if col_flete and not pd.isna(row[col_flete]): f = str(row[col_flete]).upper().strip()
+
+        p = False
+        if col_peligroso and not pd.isna(row[col_peligroso]):
+            val_p = str(row[col_peligroso]).upper().strip()
+            if val_p in ['SI', 'YES', 'TRUE', '1']: p = True
+
+        cm = 0.0
+        if col_manual and not pd.isna(row[col_manual]):
+            val_m = pd.to_numeric(row[col_manual], errors='coerce')
+            if not pd.isna(val_m): cm = val_m
+
+        dict_regla = {"margen": m, "envase": e, "cod_flete": f, "peligroso": p, "costo_adicional": cm}
+        reglas[nombre] = dict_regla
+
+        nombre_base = re.sub(r'\s*X?\s*\d+\.?\d*\s*(KG|G|L|LT|GALON|ML)\s*$', '', nombre).strip()
+        if nombre_base not in reglas: reglas[nombre_base] = dict_regla
+
+    return reglas
+
+def hoja_sintetica(factor, semilla=7):
+    rnd = random.Random(semilla)
+    base = pd.read_excel("data_margenes.xlsx", header=None).dropna(subset=[3])
+    productos = base[3].astype(str).tolist()
+
+    filas = []
+    for i in range(factor):
+        for nombre in productos:
+            nombre = nombre if i == 0 else f"{nombre.rsplit(' X ', 1)[0]} V{i} X {rnd.choice(['1kg', '5kg', '25kg', '250g'])}"
+            filas.append({
+                "Producto": nombre,
+                "Margen": rnd.choice([0.2, 0.35, 25, 40, "30", "n/a", None]),
+                "Envase": rnd.choice([None, 1.2, "$2.50", "$1,200.00", " 0.88 ", "x"]),
+                "Cod. Flete": rnd.choice([None, "flete aqp/lima x kg", "NINGUNO", "FLETE LIM-AQP/TRUJ X KG"]),
+                "Peligroso": rnd.choice([None, "SI", "no", "Yes", 1]),
+                "Costo Fabricacion": rnd.choice([None, 0.5, 1.75, "-"]),
+            })
+        filas.append({"Producto": None, "Margen": 0.2})
+    return pd.DataFrame(filas)
+
+def medir(fn, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        t = time.perf_counter()
+        resultado = fn()
+        tiempos.append(time.perf_counter() - t)
+    return min(tiempos), resultado
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del compilador de reglas maestras")
+    parser.add_argument("--factor", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'filas':>8} {'iterrows s':>12} {'vector s':>10} {'speedup':>8}  iguales")
+    for factor in args.factor:
+        df = hoja_sintetica(factor)
+        t_viejo, viejo = medir(lambda: cargar_reglas_iterrows(df), args.repeticiones)
+        t_nuevo, nuevo = medir(lambda: app.reglas_desde_tabla(app.compilar_reglas(df)[0]), args.repeticiones)
+        iguales = list(viejo.items()) == list(nuevo.items())
+        print(f"{len(df):>8} {t_viejo:>12.3f} {t_nuevo:>10.3f} {t_viejo / t_nuevo:>7.1f}x  {iguales}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# =========================================================
+# 🏋️ PRUEBA DE CARGA: FLASK DEV SERVER vs MODO ASYNC
+# =========================================================
+# Uso:
+#   python carga_concurrente.py --comparar                  (levanta ambos servidores)
+#   python carga_concurrente.py --url http://127.0.0.1:5000 (servidor ya corriendo)
+
+CONSULTAS = ["", "fresa", "esencia vainilla", "sabor", "acido", "cramer 5kg", "chocolate", "x 1kg"]
+
+SERVIDORES = {
+    "flask": [sys.executable, "-c", "import app; app.app.run(port={puerto}, threaded=True)"],
+    "async": [sys.executable, "-m", "uvicorn", "app_async:app", "--port", "{puerto}", "--log-level", "warning"],
+}
+
+def percentil(valores, p):
+    if not valores: return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+def cliente(url, fin, indice):
+    latencias, errores, i = [], 0, indice
+    while time.perf_counter() < fin:
+        q = urllib.request.quote(CONSULTAS[i % len(CONSULTAS)])
+        i += 1
+        t = time.perf_counter()
+        try:
+            with urllib.request.urlopen(f"{url}/buscar?q={q}", timeout=30) as r: r.read()
+            latencias.append(time.perf_counter() - t)
+        except Exception: errores += 1
+    return latencias, errores
+
+def medir(url, clientes, segundos):
+    fin = time.perf_counter() + segundos
+    with ThreadPoolExecutor(max_workers=clientes) as pool:
+        resultados = list(pool.map(lambda i: cliente(url, fin, i), range(clientes)))
+    latencias = [l for r in resultados for l in r[0]]
+    errores = sum(r[1] for r in resultados)
+    return {
+        "req_s": len(latencias) / segundos, "errores": errores,
+        "p50_ms": percentil(latencias, 50) * 1000, "p95_ms": percentil(latencias, 95) * 1000,
+        "media_ms": (statistics.mean(latencias) * 1000) if latencias else 0.0,
+    }
+
+def esperar_servidor(url, limite=60):
+    fin = time.time() + limite
+    while time.time() < fin:
+        try:
+            with urllib.request.urlopen(f"{url}/buscar?q=__ping__", timeout=2): return True
+        except Exception: time.sleep(0.3)
+    return False
+
+def levantar(modo, puerto):
+    cmd = [c.format(puerto=puerto) for c in SERVIDORES[modo]]
+    return subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def imprimir(nombre, clientes, r):
+    print(f"{nombre:<8} {clientes:>8} {r['req_s']:>10.1f} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} {r['errores']:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga concurrente sobre /buscar")
+    parser.add_argument("--url", help="Servidor ya levantado")
+    parser.add_argument("--comparar", action="store_true", help="Levanta Flask y el modo async y compara")
+    parser.add_argument("--clientes", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--segundos", type=float, default=10)
+    args = parser.parse_args()
+
+    print(f"{'servidor':<8} {'clientes':>8} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'errores':>8}")
+    if args.url:
+        for c in args.clientes: imprimir("url", c, medir(args.url, c, args.segundos))
+        return
+
+    modos = list(SERVIDORES) if args.comparar else ["flask"]
+    for i, modo in enumerate(modos):
+        puerto = 5101 + i
+        proc = levantar(modo, puerto)
+        try:
+            url = f"http://127.0.0.1:{puerto}"
+            if not esperar_servidor(url):
+                print(f"{modo}: no levantó en el puerto {puerto}")
+                continue
+            for c in args.clientes: imprimir(modo, c, medir(url, c, args.segundos))
+        finally:
+            proc.terminate()
+            proc.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from carga_concurrente import CONSULTAS, percentil
+
+# =========================================================
+# 🔁 REPRODUCCIÓN DE TRÁFICO GRABADO
+# =========================================================
+# Grabar:      GRABAR_TRAFICO=trafico.jsonl python app.py   (o uvicorn app_async:app)
+# Reproducir:  python reproducir_trafico.py trafico.jsonl --url http://127.0.0.1:5000 --velocidad 1 10 100 --token admin123
+# Sintético:   python reproducir_trafico.py trafico_sintetico.jsonl --sintetico 60 --url http://127.0.0.1:5000
+#
+# Respeta los intervalos de la grabación divididos por --velocidad. Las ediciones de
+# admin se graban con el token redactado: sin --token se reproducen como 403.
+# Las subidas de Excel (POST sin cuerpo grabado) no se pueden reproducir: se
+# listan aparte y no cuentan en las tasas de error.
+# OJO: las ediciones se aplican de verdad, usar contra una instancia local.
+
+def cargar_grabacion(archivo):
+    registros, omitidos = [], Counter()
+    with open(archivo, 'r', encoding='utf-8') as f:
+        for linea in f:
+            try: registro = json.loads(linea)
+            except ValueError: continue
+            if registro['metodo'] != 'GET' and registro.get('cuerpo') is None: omitidos[f"{registro['metodo']} {registro['ruta']}"] += 1
+            else: registros.append(registro)
+    registros.sort(key=lambda r: r['t'])
+    return registros, omitidos
+
+def generar_sintetico(archivo, url, segundos, rps=20, cada_edicion=5):
+    # Búsquedas a ritmo constante y una edición de margen (al mismo valor) cada tantos segundos
+    with urllib.request.urlopen(f"{url}/buscar?q=", timeout=30) as r: productos = json.loads(r.read())
+    rnd, registros = random.Random(7), []
+    for i in range(int(segundos * rps)):
+        registros.append({"t": i / rps, "metodo": "GET", "ruta": "/buscar", "query": urllib.parse.urlencode({"q": rnd.choice(CONSULTAS)}), "cuerpo": None, "status": 200})
+    for t in range(cada_edicion, int(segundos), cada_edicion):
+        p = rnd.choice(productos)
+        cuerpo = {"token": "***", "nombre": p['nombre'], "margen": float(p['margen'])}
+        registros.append({"t": t, "metodo": "POST", "ruta": "/api/editar-margen", "query": "", "cuerpo": cuerpo, "status": 200})
+    registros.sort(key=lambda r: r['t'])
+    with open(archivo, 'w', encoding='utf-8') as f:
+        for r in registros: f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    print(f"{len(registros)} requests sintéticos en {archivo}")
+
+def enviar(url, registro, token):
+    destino = f"{url}{registro['ruta']}" + (f"?{registro['query']}" if registro.get('query') else "")
+    datos, headers = None, {}
+    if registro.get('cuerpo') is not None:
+        cuerpo = {k: (token if k == 'token' and v == "***" and token else v) for k, v in registro['cuerpo'].items()}
+        datos, headers = json.dumps(cuerpo).encode('utf-8'), {"Content-Type": "application/json"}
+    t = time.perf_counter()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(destino, data=datos, headers=headers, method=registro['metodo']), timeout=60) as r:
+            r.read()
+            status = r.status
+    except urllib.error.HTTPError as e: status = e.code
+    except Exception: status = None
+    return t, time.perf_counter(), status
+
+def reproducir(url, registros, velocidad, clientes, token):
+    resultados, lock = [], threading.Lock()
+    t0_grabacion = registros[0]['t']
+
+    def tarea(registro, programado):
+        inicio, fin, status = enviar(url, registro, token)
+        with lock: resultados.append((registro, programado, inicio, fin, status))
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clientes) as pool:
+        for registro in registros:
+            programado = inicio + (registro['t'] - t0_grabacion) / velocidad
+            espera = programado - time.perf_counter()
+            if espera > 0: time.sleep(espera)
+            pool.submit(tarea, registro, programado)
+    duracion = time.perf_counter() - inicio
+    return resultados, duracion
+
+def es_error(registro, status):
+    # Un 403/404 que ya estaba en la grabación no es un error de la reproducción
+    return status is None or (status >= 400 and status != registro.get('status'))
+
+def resumir(nombre, filas, duracion):
+    # La latencia se cuenta desde el instante programado: incluye la cola en el pool
+    # cuando --clientes no alcanza, como la vería un cliente real
+    latencias = [(fin - prog) * 1000 for _, prog, _, fin, _ in filas]
+    servidor = [(fin - ini) * 1000 for _, _, ini, fin, _ in filas]
+    errores = sum(1 for r, _, _, _, s in filas if es_error(r, s))
+    print(f"{nombre:<32} {len(filas):>7} {len(filas) / duracion:>8.1f} {percentil(latencias, 50):>8.1f} {percentil(latencias, 95):>8.1f} "
+          f"{percentil(latencias, 99):>8.1f} {max(latencias, default=0):>8.1f} {percentil(servidor, 95):>10.1f} {100 * errores / len(filas):>6.1f}%")
+
+def buscar_durante_ediciones(resultados):
+    # /buscar cuyo intervalo se cruza con una edición en curso (la reconstrucción de la cache)
+    ediciones = [(ini, fin) for r, _, ini, fin, _ in resultados if r['metodo'] == 'POST']
+    return [x for x in resultados if x[0]['ruta'] == '/buscar' and any(ini < x[3] and x[1] < fin for ini, fin in ediciones)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Reproduce una grabación de tráfico contra una instancia local")
+    parser.add_argument("archivo", help="JSONL grabado con GRABAR_TRAFICO")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--velocidad", type=float, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--clientes", type=int, default=20, help="Requests simultáneos como máximo")
+    parser.add_argument("--token", help="Token de admin para las ediciones grabadas (se graban redactadas)")
+    parser.add_argument("--sintetico", type=float, metavar="SEGUNDOS", help="Genera primero una grabación sintética de esa duración")
+    args = parser.parse_args()
+
+    if args.sintetico: generar_sintetico(args.archivo, args.url, args.sintetico)
+    registros, omitidos = cargar_grabacion(args.archivo)
+    for ruta, n in sorted(omitidos.items()): print(f"no reproducible (sin cuerpo grabado): {ruta} x{n}")
+    if not registros: return print(f"{args.archivo}: grabación vacía")
+
+    for velocidad in args.velocidad:
+        resultados, duracion = reproducir(args.url, registros, velocidad, args.clientes, args.token)
+        retrasos = [(ini - prog) * 1000 for _, prog, ini, _, _ in resultados]
+        print(f"\n{velocidad:g}x: {len(resultados)} requests en {duracion:.1f}s "
+              f"(espera en cola p95 {percentil(retrasos, 95):.0f} ms, máx. {max(retrasos):.0f} ms)")
+        print(f"{'ruta':<32} {'n':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'máx ms':>8} {'p95 serv.':>10} {'error':>7}")
+        por_ruta = defaultdict(list)
+        for x in resultados: por_ruta[f"{x[0]['metodo']} {x[0]['ruta']}"].append(x)
+        for ruta in sorted(por_ruta): resumir(ruta, por_ruta[ruta], duracion)
+        durante = buscar_durante_ediciones(resultados)
+        if durante: resumir("GET /buscar (con edición activa)", durante, duracion)
+
+if __name__ == '__main__':
+    main()